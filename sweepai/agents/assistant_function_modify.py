@@ -1,5 +1,8 @@
+import hashlib
 import json
 import traceback
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache
 
 from loguru import logger
 
@@ -8,11 +11,17 @@ from sweepai.agents.assistant_functions import (
     search_and_replace_schema,
 )
 from sweepai.agents.assistant_wrapper import openai_assistant_call
-from sweepai.core.entities import AssistantRaisedException, Message
+from sweepai.core.entities import AssistantRaisedException, Message, Snippet
 from sweepai.utils.chat_logger import ChatLogger, discord_log_error
 from sweepai.utils.diff import generate_diff
 from sweepai.utils.progress import AssistantConversation, TicketProgress
-from sweepai.utils.utils import check_code, chunk_code
+from sweepai.utils.utils import (
+    Span,
+    check_code,
+    check_code_region,
+    chunk_code,
+    get_block_spans,
+)
 
 # Pre-amble using ideas from https://github.com/paul-gauthier/aider/blob/main/aider/coders/udiff_prompts.py
 # Doesn't regress on the benchmark but improves average code generated and avoids empty comments.
@@ -29,7 +38,14 @@ Modify the snippets above according to the request by calling the search_and_rep
 * Make the minimum necessary search_and_replaces to make changes to the snippets. Only write diffs for lines that have been asked to be changed.
 * Write multiple small changes instead of a single large change."""
 
+ASSISTANT_TOOLS = [
+    {"type": "code_interpreter"},
+    {"type": "function", "function": search_and_replace_schema},
+    {"type": "function", "function": keyword_search_schema},
+]
+
 
+@lru_cache(maxsize=4096)
 def int_to_excel_col(n):
     result = ""
     while n > 0:
@@ -49,6 +65,134 @@ MAX_CHARS = 32000
 TOOLS_MAX_CHARS = 20000
 
 
+SECTION_TEMPLATE_OVERHEAD = len('<section id="">\n\n</section id="">')
+
+
+def pack_sections(chunks: list[str], file_path: str, max_chars: int) -> list[str]:
+    """Pack the chunks into as few <sections> messages as fit under max_chars each."""
+    code_sections = []
+    # Section lengths are computed from the template, sections are rendered on flush
+    current_parts: list[tuple[str, str]] = []
+    current_len = 0
+
+    def flush():
+        current_code_section = "\n".join(
+            f'<section id="{idx}">\n{chunk}\n</section id="{idx}">'
+            for idx, chunk in current_parts
+        )
+        code_sections.append(
+            f"# Code\nFile path:{file_path}\n<sections>\n{current_code_section}\n</sections>"
+        )
+
+    for i, chunk in enumerate(chunks):
+        idx = int_to_excel_col(i + 1)
+        sd_len = SECTION_TEMPLATE_OVERHEAD + 2 * len(idx) + len(chunk)
+        if current_parts and current_len + sd_len + 1 > max_chars - 1000:
+            flush()
+            current_parts = []
+            current_len = 0
+        current_parts.append((idx, chunk))
+        current_len += sd_len + 1
+    if current_parts or not code_sections:
+        flush()
+    return code_sections
+
+
+def find_sections_containing(
+    text: str, chunks_bytes: list[bytes], limit: int | None = None
+) -> list[int]:
+    """Return the ids of the first limit sections containing text.
+
+    chunks_bytes are the UTF-8 encoded chunks, since matching encoded text is exact
+    and avoids comparing wide strings when a chunk has any non-ASCII character.
+    """
+    text_bytes = text.encode()
+    matches = []
+    for i, chunk_bytes in enumerate(chunks_bytes):
+        if text_bytes in chunk_bytes:
+            matches.append(i)
+            if len(matches) == limit:
+                break
+    return matches
+
+
+def index_sections(
+    snippets: list[Snippet], lines: list[str]
+) -> tuple[list[str], list[bytes], list[str]]:
+    chunks = ["\n".join(lines[snippet.start : snippet.end]) for snippet in snippets]
+    chunks_bytes = [chunk.encode() for chunk in chunks]
+    section_ids = [int_to_excel_col(i + 1) for i in range(len(chunks))]
+    return chunks, chunks_bytes, section_ids
+
+
+def get_enclosing_region(block_spans: list[Span], start: int, end: int) -> Span:
+    """Expand the line range [start, end) to the top-level blocks it overlaps."""
+    region = Span(start, end)
+    for span in block_spans:
+        if span.start < end and span.end > start:
+            region = Span(min(region.start, span.start), max(region.end, span.end))
+    return region
+
+
+def rechunk_edited_sections(
+    snippets: list[Snippet],
+    edited_section_lengths: dict[int, int],
+    contents: str,
+    contents_lines: list[str],
+    file_path: str,
+) -> list[Snippet]:
+    """Re-chunk only the edited sections, given their new lengths in lines, and shift the sections after them."""
+    new_snippets = []
+    line_delta = 0
+    for section_id, snippet in enumerate(snippets):
+        if section_id not in edited_section_lengths:
+            new_snippets.append(
+                snippet
+                if line_delta == 0
+                else Snippet(
+                    content=contents,
+                    start=snippet.start + line_delta,
+                    end=snippet.end + line_delta,
+                    file_path=file_path,
+                )
+            )
+            continue
+        window = Span(
+            snippet.start + line_delta,
+            snippet.start + line_delta + edited_section_lengths[section_id],
+        )
+        line_delta += edited_section_lengths[section_id] - (snippet.end - snippet.start)
+        window_snippets = [
+            Snippet(
+                content=contents,
+                start=window.start + window_snippet.start,
+                end=window.start + window_snippet.end,
+                file_path=file_path,
+            )
+            for window_snippet in chunk_code(
+                "\n".join(contents_lines[window.start : window.end]),
+                file_path,
+                700,
+                200,
+            )
+            if window_snippet.end > window_snippet.start
+        ]
+        # Make sure the edited lines stay visible even if the chunker trims the window
+        if not window_snippets:
+            window_snippets = [
+                Snippet(
+                    content=contents,
+                    start=window.start,
+                    end=window.end,
+                    file_path=file_path,
+                )
+            ]
+        window_snippets[0].start = window.start
+        window_snippets[-1].end = window.end
+        new_snippets.extend(window_snippets)
+    return new_snippets
+
+
 # @file_cache(ignore_params=["file_path", "chat_logger"])
 def function_modify(
     request: str,
@@ -62,7 +206,10 @@ def function_modify(
     ticket_progress: TicketProgress | None = None,
     assistant_conversation: AssistantConversation | None = None,
     seed: int = None,
+    initial_code_valid: bool | None = None,
 ):
+    # Lints in the background while waiting on the assistant
+    check_executor = ThreadPoolExecutor(max_workers=1)
     try:
 
         def save_ticket_progress(assistant_id: str, thread_id: str, run_id: str):
@@ -72,31 +219,38 @@ def function_modify(
                 )
             ticket_progress.save()
 
+        check_cache: dict[bytes, Future] = {}
+
+        def check_code_async(code: str) -> Future:
+            # The assistant often retries the same edit, so don't lint the same contents twice
+            code_hash = hashlib.blake2b(code.encode(), digest_size=16).digest()
+            if code_hash not in check_cache or check_cache[code_hash].cancelled():
+                check_cache[code_hash] = check_executor.submit(
+                    check_code, file_path, code
+                )
+            return check_cache[code_hash]
+
+        def cached_check_code(code: str) -> tuple[bool, str]:
+            return check_code_async(code).result()
+
         current_contents = file_contents
-        initial_code_valid, _ = check_code(file_path, current_contents)
+        # Callers that already linted the file can pass initial_code_valid to skip this
+        if initial_code_valid is None:
+            initial_code_valid, _ = cached_check_code(current_contents)
         initial_code_valid = initial_code_valid or (
             "<<<<<<<" in current_contents and ">>>>>>>" in current_contents
         )  # If there's a merge conflict, we still check that the final code is valid
 
         original_snippets = chunk_code(current_contents, file_path, 700, 200)
         file_contents_lines = current_contents.split("\n")
-        chunks = [
-            "\n".join(file_contents_lines[snippet.start : snippet.end])
-            for snippet in original_snippets
-        ]
-        code_sections = []  # TODO: do this for the new sections after modifications
-        current_code_section = ""
-        for i, chunk in enumerate(chunks):
-            idx = int_to_excel_col(i + 1)
-            section_display = f'<section id="{idx}">\n{chunk}\n</section id="{idx}">'
-            if len(current_code_section) + len(section_display) > MAX_CHARS - 1000:
-                code_sections_string = f"# Code\nFile path:{file_path}\n<sections>\n{current_code_section}\n</sections>"
-                code_sections.append(code_sections_string)
-                current_code_section = section_display
-            else:
-                current_code_section += "\n" + section_display
-        code_sections.append(current_code_section)
-        code_sections_string = "\n".join(code_sections)
+        chunks, chunks_bytes, section_ids = index_sections(
+            original_snippets, file_contents_lines
+        )
+        block_spans = (
+            get_block_spans(file_path, current_contents) if initial_code_valid else []
+        )
+
+        code_sections = pack_sections(chunks, file_path, MAX_CHARS)
         additional_messages += [
             *reversed(
                 [
@@ -122,22 +276,22 @@ def function_modify(
                 save_ticket_progress if ticket_progress is not None else None
             ),
             assistant_name="Code Modification Function Assistant",
-            tools=[
-                {"type": "code_interpreter"},
-                {"type": "function", "function": search_and_replace_schema},
-                {"type": "function", "function": keyword_search_schema},
-            ],
+            tools=ASSISTANT_TOOLS,
         )
 
         try:
             tool_name, tool_call = assistant_generator.send(None)
             for i in range(50):
-                print(tool_name, json.dumps(tool_call, indent=2))
+                logger.opt(lazy=True).debug(
+                    "{} {}", lambda: tool_name, lambda: json.dumps(tool_call, indent=2)
+                )
                 if tool_name == "search_and_replace":
                     error_message = ""
                     success_message = ""
                     new_contents = current_contents
-                    new_chunks = [chunk for chunk in chunks]  # deepcopy
+                    # Only the edited sections, so unedited chunks are never copied
+                    edited_chunks: dict[int, str] = {}
+                    any_change = False
 
                     if "replaces_to_make" not in tool_call:
                         error_message = "No replaces_to_make found in tool call."
@@ -161,74 +315,102 @@ def function_modify(
                             if section_id >= len(chunks):
                                 error_message = f"Could not find section {section_letter} in file {file_path}, which has {len(chunks)} sections."
                                 break
-                            chunk = new_chunks[section_id]
-                            if old_code not in chunk:
-                                chunks_with_old_code = [
-                                    index
-                                    for index, chunk in enumerate(chunks)
-                                    if old_code in chunk
-                                ]
-                                chunks_with_old_code = chunks_with_old_code[:5]
+                            chunk = edited_chunks.get(section_id, chunks[section_id])
+                            # Locate the first line, then confirm the rest in place
+                            first_line = old_code.split("\n", 1)[0]
+                            idx = chunk.find(first_line)
+                            if idx != -1 and not chunk.startswith(old_code, idx):
+                                idx = chunk.find(old_code, idx + 1)
+                            if idx == -1:
+                                chunks_with_old_code = find_sections_containing(
+                                    old_code, chunks_bytes, limit=5
+                                )
                                 error_message = f"The old_code in the {index}th replace_to_make does not appear to be present in section {section_letter}. The old_code contains:\n```\n{old_code}\n```\nBut section {section_letter} has code:\n```\n{chunk}\n```"
                                 if chunks_with_old_code:
                                     error_message += f"\n\nDid you mean one of the following sections?"
                                     error_message += "\n".join(
                                         [
-                                            f'\n<section id="{int_to_excel_col(index + 1)}">\n{chunks[index]}\n</section>\n```'
+                                            f'\n<section id="{section_ids[index]}">\n{chunks[index]}\n</section>\n```'
                                             for index in chunks_with_old_code
                                         ]
                                     )
                                 else:
                                     error_message += f"\n\nMake another replacement. In the analysis_and_identification, first identify the indentation or spelling error. Consider missing or misplaced whitespace, comments or delimiters. Then, identify what should be the correct old_code, and make another replacement with the corrected old_code."
                                 break
-                            new_chunk = chunk.replace(old_code, new_code, 1)
+                            new_chunk = (
+                                chunk[:idx] + new_code + chunk[idx + len(old_code) :]
+                            )
                             if new_chunk == chunk:
                                 logger.warning("No changes were made to the code.")
-                            new_chunks[section_id] = new_chunk
-                            new_contents = new_contents.replace(chunk, new_chunk, 1)
-                            if new_contents == current_contents:
-                                logger.warning("No changes were made to the code.")
+                            else:
+                                any_change = True
+                            edited_chunks[section_id] = new_chunk
+
+                    if not error_message and any_change:
+                        # Splice by line range, back to front so earlier offsets stay valid
+                        new_contents_lines = list(file_contents_lines)
+                        edited_section_lengths: dict[int, int] = {}
+                        for section_id in sorted(edited_chunks, reverse=True):
+                            snippet = original_snippets[section_id]
+                            new_section_lines = edited_chunks[section_id].split("\n")
+                            new_contents_lines[
+                                snippet.start : snippet.end
+                            ] = new_section_lines
+                            edited_section_lengths[section_id] = len(new_section_lines)
+                        new_contents = "\n".join(new_contents_lines)
 
-                    if not error_message and new_contents == current_contents:
+                    if not error_message and not any_change:
                         error_message = "No changes were made, make sure old_code and new_code are not the same."
 
                     if not error_message:
+                        line_delta = len(new_contents_lines) - len(file_contents_lines)
                         # If the initial code failed, we don't need to/can't check the new code
-                        is_valid, message = (
-                            (True, "")
-                            if not initial_code_valid
-                            else check_code(file_path, new_contents)
-                        )
+                        is_valid, message = True, ""
+                        check: Future | None = None
+                        if initial_code_valid:
+                            # Cheaply reject edits that break their own block before checking the whole file
+                            edited_snippets = [
+                                original_snippets[section_id]
+                                for section_id in edited_chunks
+                            ]
+                            region = get_enclosing_region(
+                                block_spans,
+                                min(snippet.start for snippet in edited_snippets),
+                                max(snippet.end for snippet in edited_snippets),
+                            )
+                            is_valid, message = check_code_region(
+                                file_path,
+                                new_contents_lines,
+                                region.start,
+                                region.end + line_delta,
+                            )
+                            if is_valid:
+                                # Lint in the background while the edited sections are re-chunked
+                                check = check_code_async(new_contents)
+                        diff = generate_diff(current_contents, new_contents)
                         if is_valid:
-                            diff = generate_diff(current_contents, new_contents)
-                            current_contents = new_contents
-
-                            # Re-initialize
-                            original_snippets = chunk_code(
-                                current_contents, file_path, 700, 200
+                            new_snippets = rechunk_edited_sections(
+                                original_snippets,
+                                edited_section_lengths,
+                                new_contents,
+                                new_contents_lines,
+                                file_path,
                             )
-                            file_contents_lines = current_contents.split("\n")
-                            chunks = [
-                                "\n".join(
-                                    file_contents_lines[snippet.start : snippet.end]
+                            new_index = index_sections(new_snippets, new_contents_lines)
+                            # Wait for the lint before replying, as the assistant may stop after any SUCCESS
+                            if check is not None:
+                                is_valid, message = check.result()
+                        if is_valid:
+                            # Re-initialize
+                            current_contents = new_contents
+                            original_snippets = new_snippets
+                            file_contents_lines = new_contents_lines
+                            chunks, chunks_bytes, section_ids = new_index
+                            if initial_code_valid:
+                                block_spans = get_block_spans(
+                                    file_path, current_contents
                                 )
-                                for snippet in original_snippets
-                            ]
-                            code_sections = []
-                            current_code_section = ""
-                            for i, chunk in enumerate(chunks):
-                                idx = int_to_excel_col(i + 1)
-                                section_display = f'<section id="{idx}">\n{chunk}\n</section id="{idx}">'
-                                if (
-                                    len(current_code_section) + len(section_display)
-                                    > MAX_CHARS
-                                ):
-                                    code_sections_string = f"# Code\nFile path:{file_path}\n<sections>\n{current_code_section}\n</sections>"
-                                    code_sections.append(code_sections_string)
-                                    current_code_section = section_display
-                                else:
-                                    current_code_section += "\n" + section_display
-                            code_sections.append(current_code_section)
+                            code_sections = pack_sections(chunks, file_path, MAX_CHARS)
                             new_current_code = f"\n\n{code_sections[0]}"
                             max_allowed_chars = TOOLS_MAX_CHARS - 1000 - len(diff)
                             if len(new_current_code) > max_allowed_chars:
@@ -238,7 +420,6 @@ def function_modify(
                                 )
                             success_message = f"The following changes have been applied:\n```diff\n{diff}\n```\nHere are the new code sections:\n\n{new_current_code}\n\nYou can continue to make changes to the code sections and call the `search_and_replace` function again."
                         else:
-                            diff = generate_diff(current_contents, new_contents)
                             error_message = f"No changes have been applied. This is because when the following changes are applied:\n\n```diff\n{diff}\n```\n\nIt yields invalid code with the following error message:\n```\n{message}\n```\n\nPlease retry the search_and_replace with different changes that yield valid code."
 
                     if error_message:
@@ -262,10 +443,7 @@ def function_modify(
 
                     if not error_message:
                         keyword = tool_call["keyword"]
-                        matches = []
-                        for i, chunk in enumerate(chunks):
-                            if keyword in chunk:
-                                matches.append(i)
+                        matches = find_sections_containing(keyword, chunks_bytes)
                         if not matches:
                             error_message = f"The keyword {keyword} does not appear to be present in the code. Consider missing or misplaced whitespace, comments or delimiters."
                         else:
@@ -275,32 +453,20 @@ def function_modify(
                         for match_index in matches:
                             match = chunks[match_index]
                             match_lines = match.split("\n")
-                            lines_containing_keyword = [
-                                i
-                                for i, line in enumerate(match_lines)
-                                if keyword in line
-                            ]
-                            cols_of_keyword = [
-                                match_lines[line_containing_keyword].index(keyword)
-                                for line_containing_keyword in lines_containing_keyword
-                            ]
-                            match_display = ""
+                            cols_by_line: dict[int, int] = {}
+                            for i, line in enumerate(match_lines):
+                                col = line.find(keyword)
+                                if col != -1:
+                                    cols_by_line[i] = col
+                            match_display_parts = []
                             for i, line in enumerate(match_lines):
-                                if i in lines_containing_keyword:
-                                    match_display += (
-                                        f"{line}\n"
-                                        + " "
-                                        * (
-                                            cols_of_keyword[
-                                                lines_containing_keyword.index(i)
-                                            ]
-                                        )
-                                        + "^\n"
+                                match_display_parts.append(line)
+                                if i in cols_by_line:
+                                    match_display_parts.append(
+                                        " " * cols_by_line[i] + "^"
                                     )
-                                else:
-                                    match_display += f"{line}\n"
-                            match_display = match_display.strip("\n")
-                            success_message += f"<section id='{int_to_excel_col(match_index + 1)}'> ({len(lines_containing_keyword)} matches)\n{match_display}\n</section>\n"
+                            match_display = "\n".join(match_display_parts).strip("\n")
+                            success_message += f"<section id='{section_ids[match_index]}'> ({len(cols_by_line)} matches)\n{match_display}\n</section>\n"
 
                     if error_message:
                         logger.debug(error_message)
@@ -350,6 +516,8 @@ def function_modify(
             + str(ticket_progress.tracking_id if ticket_progress else "")
         )
         return None
+    finally:
+        check_executor.shutdown(wait=False, cancel_futures=True)
     return None
 
 
@@ -369,6 +537,7 @@ if __name__ == "__main__":
         request=request,
         file_path="sweepai/handlers/on_ticket.py",
         file_contents=file_contents,
+        initial_code_valid=True,
         chat_logger=ChatLogger(
             {
                 "username": "kevinlu1248",
@@ -0,0 +1,536 @@
+import unittest
+from unittest.mock import MagicMock, patch
+
+from sweepai.agents.assistant_function_modify import (
+    excel_col_to_int,
+    find_sections_containing,
+    function_modify,
+    int_to_excel_col,
+    pack_sections,
+    rechunk_edited_sections,
+)
+from sweepai.utils.utils import chunk_code
+
+file_contents = """\
+import os
+
+
+def get_home():
+    return os.environ["HOME"]
+
+
+def get_user():
+    return os.environ["USER"]
+
+
+if __name__ == "__main__":
+    print(get_home(), get_user())
+"""
+
+
+def mock_assistant(tool_calls: list[tuple[str, dict]], responses: list[str]):
+    def assistant_call(**kwargs):
+        for tool_call in tool_calls:
+            responses.append((yield tool_call))
+
+    return assistant_call
+
+
+class TestPackSections(unittest.TestCase):
+    def test_single_bin(self):
+        sections = pack_sections(["a = 1", "b = 2"], "main.py", 32000)
+        self.assertEqual(
+            sections,
+            [
+                '# Code\nFile path:main.py\n<sections>\n<section id="A">\na = 1\n</section id="A">\n<section id="B">\nb = 2\n</section id="B">\n</sections>'
+            ],
+        )
+
+    def test_splits_into_bins(self):
+        chunks = ["x" * 600 for _ in range(5)]
+        sections = pack_sections(chunks, "main.py", 2400)
+        self.assertEqual(len(sections), 3)
+        for section in sections:
+            self.assertTrue(section.startswith("# Code\nFile path:main.py\n<sections>"))
+        self.assertIn('<section id="E">', sections[-1])
+
+    def test_empty(self):
+        self.assertEqual(
+            pack_sections([], "main.py", 32000),
+            ["# Code\nFile path:main.py\n<sections>\n\n</sections>"],
+        )
+
+
+class TestExcelCol(unittest.TestCase):
+    def test_round_trip(self):
+        for i in range(1, 1000):
+            self.assertEqual(excel_col_to_int(int_to_excel_col(i)), i - 1)
+
+
+class TestFindSectionsContaining(unittest.TestCase):
+    def test_matches_substring_scan(self):
+        chunks = [
+            "def get_home():\n    return os.environ['HOME']",
+            "def get_user():\n    return getenv('USER')",
+            "import os\n",
+            "name = 'HOMÉ'\n",
+        ]
+        chunks_bytes = [chunk.encode() for chunk in chunks]
+        for keyword in [
+            "env",
+            "environ",
+            "os",
+            "get_",
+            "os.environ",
+            "('",
+            "HOMER",
+            "return os.environ['HO",
+            "get_home():\n    return",
+            "def get_user():\n    return getenv",
+            "import os.path",
+            "é",
+            "'HOMÉ'",
+        ]:
+            self.assertEqual(
+                find_sections_containing(keyword, chunks_bytes),
+                [i for i, chunk in enumerate(chunks) if keyword in chunk],
+                keyword,
+            )
+
+    def test_limit(self):
+        chunks = [f"def f{i}():\n    return os.environ['HOME']" for i in range(10)]
+        chunks_bytes = [chunk.encode() for chunk in chunks]
+        for keyword in ["environ", "os.environ['HOME']"]:
+            self.assertEqual(
+                find_sections_containing(keyword, chunks_bytes, limit=5),
+                [0, 1, 2, 3, 4],
+            )
+
+
+class TestRechunkEditedSections(unittest.TestCase):
+    def test_only_edited_sections_change(self):
+        contents = "\n\n\n".join(f"def f{i}():\n    return {i}" for i in range(200))
+        snippets = chunk_code(contents, "main.py", 700, 200)
+        lines = contents.split("\n")
+        edited = snippets[2]
+        new_lines = (
+            lines[: edited.start]
+            + ["# one", "# two"]
+            + lines[edited.start : edited.end]
+            + lines[edited.end :]
+        )
+        new_contents = "\n".join(new_lines)
+        new_snippets = rechunk_edited_sections(
+            snippets,
+            {2: edited.end - edited.start + 2},
+            new_contents,
+            new_lines,
+            "main.py",
+        )
+        self.assertEqual(
+            [(s.start, s.end) for s in new_snippets[:2]],
+            [(s.start, s.end) for s in snippets[:2]],
+        )
+        self.assertEqual(
+            [(s.start + 2, s.end + 2) for s in snippets[3:]],
+            [(s.start, s.end) for s in new_snippets[-len(snippets[3:]) :]],
+        )
+        rechunked = new_snippets[2 : len(new_snippets) - len(snippets[3:])]
+        self.assertEqual(rechunked[0].start, edited.start)
+        self.assertEqual(rechunked[-1].end, edited.end + 2)
+
+
+class TestFunctionModify(unittest.TestCase):
+    def run_function_modify(
+        self,
+        tool_calls,
+        file_contents=file_contents,
+        file_path="main.py",
+        check_code=None,
+        **kwargs,
+    ):
+        responses = []
+        with patch(
+            "sweepai.agents.assistant_function_modify.openai_assistant_call",
+            mock_assistant(tool_calls, responses),
+        ), patch(
+            "sweepai.agents.assistant_function_modify.check_code",
+            check_code or MagicMock(return_value=(True, "")),
+        ):
+            new_contents = function_modify(
+                request="Use getenv",
+                file_path=file_path,
+                file_contents=file_contents,
+                additional_messages=[],
+                **kwargs,
+            )
+        return new_contents, responses
+
+    def test_search_and_replace(self):
+        new_contents, responses = self.run_function_modify(
+            [
+                (
+                    "search_and_replace",
+                    {
+                        "replaces_to_make": [
+                            {
+                                "section_id": "A",
+                                "old_code": 'os.environ["HOME"]',
+                                "new_code": 'os.getenv("HOME")',
+                            },
+                            {
+                                "section_id": "A",
+                                "old_code": 'os.environ["USER"]',
+                                "new_code": 'os.getenv("USER")',
+                            },
+                        ]
+                    },
+                ),
+            ]
+        )
+        self.assertEqual(
+            new_contents,
+            file_contents.replace('os.environ["HOME"]', 'os.getenv("HOME")').replace(
+                'os.environ["USER"]', 'os.getenv("USER")'
+            ),
+        )
+        self.assertTrue(responses[0].startswith("SUCCESS"))
+
+    def test_search_and_replace_multiple_sections(self):
+        long_file_contents = (
+            "\n\n\n".join(f"def f{i}():\n    return {i}" for i in range(200)) + "\n"
+        )
+        new_contents, responses = self.run_function_modify(
+            [
+                (
+                    "search_and_replace",
+                    {
+                        "replaces_to_make": [
+                            {
+                                "section_id": "A",
+                                "old_code": "def f1():\n    return 1",
+                                "new_code": "def f1():\n    x = 1\n    return x",
+                            },
+                            {
+                                "section_id": "C",
+                                "old_code": "def f60():\n    return 60",
+                                "new_code": "def f60():\n    pass",
+                            },
+                        ]
+                    },
+                ),
+                (
+                    "search_and_replace",
+                    {
+                        "replaces_to_make": [
+                            {
+                                "section_id": "C",
+                                "old_code": "def f61():\n    return 61",
+                                "new_code": "def f61():\n    pass",
+                            },
+                        ]
+                    },
+                ),
+            ],
+            file_contents=long_file_contents,
+        )
+        self.assertEqual(
+            new_contents,
+            long_file_contents.replace(
+                "def f1():\n    return 1\n", "def f1():\n    x = 1\n    return x\n"
+            )
+            .replace("def f60():\n    return 60\n", "def f60():\n    pass\n")
+            .replace("def f61():\n    return 61\n", "def f61():\n    pass\n"),
+        )
+        self.assertTrue(responses[0].startswith("SUCCESS"))
+        self.assertTrue(responses[1].startswith("SUCCESS"))
+
+    def test_invalid_edit_is_rejected(self):
+        new_contents, responses = self.run_function_modify(
+            [
+                (
+                    "search_and_replace",
+                    {
+                        "replaces_to_make": [
+                            {
+                                "section_id": "A",
+                                "old_code": "def get_user():",
+                                "new_code": "def get_user(:",
+                            },
+                        ]
+                    },
+                ),
+            ]
+        )
+        self.assertIsNone(new_contents)
+        self.assertTrue(responses[0].startswith("ERROR"))
+        self.assertIn("Python syntax error", responses[0])
+
+    def test_invalid_edit_is_rejected_in_other_languages(self):
+        new_contents, responses = self.run_function_modify(
+            [
+                (
+                    "search_and_replace",
+                    {
+                        "replaces_to_make": [
+                            {
+                                "section_id": "A",
+                                "old_code": "return 2;",
+                                "new_code": "return (2;",
+                            },
+                        ]
+                    },
+                ),
+            ],
+            file_contents="function f() {\n  return 2;\n}\n",
+            file_path="main.js",
+            initial_code_valid=True,
+        )
+        self.assertIsNone(new_contents)
+        self.assertTrue(responses[0].startswith("ERROR"))
+        self.assertIn("Invalid syntax", responses[0])
+
+    def test_last_invalid_edit_is_rejected(self):
+        check_code = MagicMock(
+            side_effect=lambda file_path, code: (
+                ("home_dir" not in code, "Undefined variable 'home_dir'")
+            )
+        )
+        new_contents, responses = self.run_function_modify(
+            [
+                (
+                    "search_and_replace",
+                    {
+                        "replaces_to_make": [
+                            {
+                                "section_id": "A",
+                                "old_code": 'os.environ["USER"]',
+                                "new_code": 'os.getenv("USER")',
+                            },
+                        ]
+                    },
+                ),
+                (
+                    "search_and_replace",
+                    {
+                        "replaces_to_make": [
+                            {
+                                "section_id": "A",
+                                "old_code": 'os.environ["HOME"]',
+                                "new_code": "home_dir",
+                            },
+                        ]
+                    },
+                ),
+            ],
+            check_code=check_code,
+        )
+        self.assertEqual(
+            new_contents,
+            file_contents.replace('os.environ["USER"]', 'os.getenv("USER")'),
+        )
+        self.assertTrue(responses[0].startswith("SUCCESS"))
+        # The last edit is linted before replying, so the assistant sees its error
+        self.assertEqual(len(responses), 2)
+        self.assertTrue(responses[1].startswith("ERROR"))
+        self.assertIn("No changes have been applied", responses[1])
+        self.assertIn("Undefined variable 'home_dir'", responses[1])
+        # The initial contents, then each edit
+        self.assertEqual(check_code.call_count, 3)
+
+    def test_failed_lint_keeps_next_tool_call(self):
+        check_code = MagicMock(
+            side_effect=lambda file_path, code: (
+                ("home_dir" not in code, "Undefined variable 'home_dir'")
+            )
+        )
+        new_contents, responses = self.run_function_modify(
+            [
+                (
+                    "search_and_replace",
+                    {
+                        "replaces_to_make": [
+                            {
+                                "section_id": "A",
+                                "old_code": 'os.environ["HOME"]',
+                                "new_code": "home_dir",
+                            },
+                        ]
+                    },
+                ),
+                (
+                    "search_and_replace",
+                    {
+                        "replaces_to_make": [
+                            {
+                                "section_id": "A",
+                                "old_code": 'os.environ["HOME"]',
+                                "new_code": 'os.getenv("HOME")',
+                            },
+                        ]
+                    },
+                ),
+                (
+                    "keyword_search",
+                    {"justification": "Find usages", "keyword": "getenv"},
+                ),
+            ],
+            check_code=check_code,
+            initial_code_valid=True,
+        )
+        self.assertEqual(
+            new_contents,
+            file_contents.replace('os.environ["HOME"]', 'os.getenv("HOME")'),
+        )
+        self.assertTrue(responses[0].startswith("ERROR"))
+        self.assertIn("Undefined variable 'home_dir'", responses[0])
+        self.assertTrue(responses[1].startswith("SUCCESS"))
+        self.assertTrue(responses[2].startswith("SUCCESS"))
+        self.assertIn('os.getenv("HOME")', responses[2])
+
+    def test_check_code_is_cached(self):
+        replace_call = (
+            "search_and_replace",
+            {
+                "replaces_to_make": [
+                    {
+                        "section_id": "A",
+                        "old_code": 'os.environ["HOME"]',
+                        "new_code": "home_dir",
+                    },
+                ]
+            },
+        )
+        check_code = MagicMock(
+            side_effect=lambda file_path, code: (
+                ("home_dir" not in code, "Undefined variable 'home_dir'")
+            )
+        )
+        new_contents, responses = self.run_function_modify(
+            [
+                replace_call,
+                ("keyword_search", {"justification": "Find usages", "keyword": "os"}),
+                replace_call,
+            ],
+            check_code=check_code,
+        )
+        self.assertIsNone(new_contents)
+        self.assertTrue(responses[0].startswith("ERROR"))
+        self.assertTrue(responses[1].startswith("SUCCESS"))
+        self.assertTrue(responses[2].startswith("ERROR"))
+        self.assertEqual(responses[0], responses[2])
+        self.assertEqual(check_code.call_count, 2)
+
+    def test_old_code_first_line_repeated(self):
+        new_contents, responses = self.run_function_modify(
+            [
+                (
+                    "search_and_replace",
+                    {
+                        "replaces_to_make": [
+                            {
+                                "section_id": "A",
+                                "old_code": ':\n    return os.environ["USER"]',
+                                "new_code": ':\n    return os.getenv("USER")',
+                            },
+                        ]
+                    },
+                ),
+            ]
+        )
+        self.assertEqual(
+            new_contents,
+            file_contents.replace('os.environ["USER"]', 'os.getenv("USER")'),
+        )
+        self.assertTrue(responses[0].startswith("SUCCESS"))
+
+    def test_initial_code_valid_skips_initial_check(self):
+        check_code = MagicMock(return_value=(True, ""))
+        new_contents, responses = self.run_function_modify(
+            [
+                (
+                    "search_and_replace",
+                    {
+                        "replaces_to_make": [
+                            {
+                                "section_id": "A",
+                                "old_code": 'os.environ["HOME"]',
+                                "new_code": 'os.getenv("HOME")',
+                            },
+                        ]
+                    },
+                ),
+            ],
+            check_code=check_code,
+            initial_code_valid=True,
+        )
+        self.assertEqual(
+            new_contents,
+            file_contents.replace('os.environ["HOME"]', 'os.getenv("HOME")'),
+        )
+        check_code.assert_called_once_with("main.py", new_contents)
+
+    def test_no_changes(self):
+        new_contents, responses = self.run_function_modify(
+            [
+                (
+                    "search_and_replace",
+                    {
+                        "replaces_to_make": [
+                            {
+                                "section_id": "A",
+                                "old_code": 'os.environ["HOME"]',
+                                "new_code": 'os.environ["HOME"]',
+                            },
+                        ]
+                    },
+                ),
+            ]
+        )
+        self.assertIsNone(new_contents)
+        self.assertTrue(responses[0].startswith("ERROR"))
+        self.assertIn("No changes were made", responses[0])
+
+    def test_missing_old_code(self):
+        new_contents, responses = self.run_function_modify(
+            [
+                (
+                    "search_and_replace",
+                    {
+                        "replaces_to_make": [
+                            {
+                                "section_id": "A",
+                                "old_code": "os.environ['HOME']",
+                                "new_code": 'os.getenv("HOME")',
+                            },
+                        ]
+                    },
+                ),
+            ]
+        )
+        self.assertIsNone(new_contents)
+        self.assertTrue(responses[0].startswith("ERROR"))
+        self.assertIn("does not appear to be present in section A", responses[0])
+
+    def test_keyword_search(self):
+        new_contents, responses = self.run_function_modify(
+            [
+                (
+                    "keyword_search",
+                    {"justification": "Find usages", "keyword": "environ"},
+                ),
+                (
+                    "keyword_search",
+                    {"justification": "Find usages", "keyword": "getenv"},
+                ),
+            ]
+        )
+        self.assertIsNone(new_contents)
+        self.assertTrue(responses[0].startswith("SUCCESS"))
+        self.assertIn("<section id='A'> (2 matches)", responses[0])
+        self.assertIn('    return os.environ["HOME"]\n              ^', responses[0])
+        self.assertTrue(responses[1].startswith("ERROR"))
+
+
+if __name__ == "__main__":
+    unittest.main()
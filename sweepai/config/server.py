@@ -33,6 +33,9 @@ SENTENCE_TRANSFORMERS_MODEL = os.environ.get(
 BATCH_SIZE = int(
     os.environ.get("BATCH_SIZE", 32)
 )  # Tune this to 32 for sentence-transformers/all-MiniLM-L6-v2 on CPU
+SWEEP_TOKENIZE_WORKERS = int(
+    os.environ.get("SWEEP_TOKENIZE_WORKERS", min(os.cpu_count() or 1, 16))
+)  # Processes used to tokenize documents for the lexical index, returns diminish past 8-16
 
 TEST_BOT_NAME = "sweep-nightly[bot]"
 ENV = os.environ.get("ENV", "dev")
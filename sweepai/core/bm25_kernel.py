@@ -0,0 +1,52 @@
+import numpy as np
+
+# numba is optional, without it the scores are accumulated with NumPy one term at a time
+try:
+    from numba import njit
+
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+
+# weights are each term's idf * (k1 + 1) and k1_len_norm is k1 * (1 - b + b * dl / avgdl),
+# leaving a multiply, an add and a divide per posting
+def score_numpy(
+    query_term_ids: np.ndarray,
+    weights: np.ndarray,
+    offsets: np.ndarray,
+    doc_idxs: np.ndarray,
+    freqs: np.ndarray,
+    k1_len_norm: np.ndarray,
+    out: np.ndarray,
+) -> None:
+    for term_id in query_term_ids:
+        start, end = offsets[term_id], offsets[term_id + 1]
+        term_doc_idxs = doc_idxs[start:end]
+        term_freqs = freqs[start:end]
+        tf = term_freqs / (term_freqs + k1_len_norm[term_doc_idxs])
+        np.add.at(out, term_doc_idxs, weights[term_id] * tf)
+
+
+def score_loop(
+    query_term_ids: np.ndarray,
+    weights: np.ndarray,
+    offsets: np.ndarray,
+    doc_idxs: np.ndarray,
+    freqs: np.ndarray,
+    k1_len_norm: np.ndarray,
+    out: np.ndarray,
+) -> None:
+    # Same as score_numpy, written as plain loops for numba to compile
+    for term_id in query_term_ids:
+        start, end = offsets[term_id], offsets[term_id + 1]
+        for posting in range(start, end):
+            doc_idx = doc_idxs[posting]
+            freq = freqs[posting]
+            out[doc_idx] += weights[term_id] * freq / (freq + k1_len_norm[doc_idx])
+
+
+if NUMBA_AVAILABLE:
+    score = njit(cache=True, fastmath=True)(score_loop)
+else:
+    score = score_numpy
@@ -1,214 +1,579 @@
-# import multiprocessing
+import glob
 import json
+import multiprocessing
+import os
 import re
-from collections import Counter, defaultdict
+import shutil
+import stat
 from dataclasses import dataclass
-from math import log
+from functools import lru_cache
+from hashlib import blake2b
+from typing import Iterator, NamedTuple
 
+import numpy as np
 from redis import Redis
 from tqdm import tqdm
-from whoosh.analysis import Token, Tokenizer
 
-from sweepai.config.server import REDIS_URL, DEBUG
+from sweepai.config.server import DEBUG, REDIS_URL, SWEEP_TOKENIZE_WORKERS
+from sweepai.core import bm25_kernel
 from sweepai.core.entities import Snippet
 from sweepai.core.repo_parsing_utils import directory_to_chunks
 from sweepai.core.vector_db import get_query_texts_similarity
 from sweepai.logn import logger
-from sweepai.logn.cache import file_cache
+from sweepai.logn.cache import FILE_CACHE_ENABLED, file_cache
 from sweepai.utils.hash import hash_sha256
 from sweepai.utils.progress import TicketProgress
 from sweepai.utils.scorer import compute_score, get_scores
 
 CACHE_VERSION = "v1.0.14"
+LEXICAL_INDEX_CACHE_DIR = "/tmp/cache/lexical_index"
+# Postings directories kept in LEXICAL_INDEX_CACHE_DIR, see CustomIndex.__getstate__
+MAX_SAVED_POSTINGS = 8
 
 if DEBUG:
     redis_client = Redis.from_url(REDIS_URL)
 else:
     redis_client = None
 
+
+def hash_terms(texts: list[str]) -> np.ndarray:
+    # Stable 64-bit term ids, the same in every process, so tokenizing in a pool needs no shared dictionary
+    return np.frombuffer(
+        b"".join(blake2b(text.encode(), digest_size=8).digest() for text in texts),
+        dtype=np.uint64,
+    )
+
+
 @file_cache()
 def compute_document_tokens(
     content: str,
-) -> list[str]:  # method that offloads the computation to a separate process
-    tokenizer = CodeTokenizer()
-    tokens = [token.text for token in tokenizer(content)]
-    return tokens
+) -> np.ndarray:  # method that offloads the computation to a separate process
+    return hash_terms(tokenize_texts(content))
+
+
+@lru_cache(maxsize=2048)
+def tokenize_query(query: str) -> tuple[np.ndarray, np.ndarray]:
+    """The sorted unique hash_terms ids of the query, and how many times each occurs.
+
+    Cached since the same query is often searched again, the arrays are read-only.
+    """
+    term_ids, counts = np.unique(hash_terms(tokenize_texts(query)), return_counts=True)
+    term_ids.flags.writeable = False
+    counts.flags.writeable = False
+    return term_ids, counts
+
+
+MIN_DOCS_FOR_POOL = 500  # below this, starting the workers costs more than it saves
+# Indexing runs in the server's handler threads, and forking a threaded process can leave
+# a worker holding a lock (e.g. loguru's) that another thread had, so workers are started
+# from a clean forkserver (or spawned where there is none) instead of forked
+POOL_START_METHOD = (
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+)
+
+
+def tokenize_document(content: str) -> np.ndarray:
+    # Module-level so the pool can pickle it, the file_cache wrapper can't be pickled
+    return compute_document_tokens(content)
+
+
+def compute_all_document_tokens(contents: list[str]) -> Iterator[np.ndarray]:
+    """Tokenize the contents in order, across SWEEP_TOKENIZE_WORKERS processes for large inputs."""
+    if SWEEP_TOKENIZE_WORKERS <= 1 or len(contents) < MIN_DOCS_FOR_POOL:
+        yield from map(compute_document_tokens, contents)
+        return
+    context = multiprocessing.get_context(POOL_START_METHOD)
+    if POOL_START_METHOD == "forkserver":
+        # Imported once by the forkserver rather than by every worker
+        context.set_forkserver_preload([__name__])
+    with context.Pool(processes=SWEEP_TOKENIZE_WORKERS) as pool:
+        yield from pool.imap(tokenize_document, contents, chunksize=32)
+
+
+def vbyte_encode(values: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """VByte encode non-negative integers below 2**35, 7 bits per byte, least significant first.
+
+    The high bit marks the last byte of each value. Returns the bytes and the number
+    of bytes used by each value.
+    """
+    values = values.astype(np.uint64)
+    num_bytes = np.ones(len(values), dtype=np.int64)
+    for shift in (7, 14, 21, 28):
+        num_bytes += values >= (1 << shift)
+    ends = np.cumsum(num_bytes)
+    byte_positions = np.arange(ends[-1] if len(ends) else 0) - np.repeat(
+        ends - num_bytes, num_bytes
+    )
+    data = (
+        (np.repeat(values, num_bytes) >> (7 * byte_positions).astype(np.uint64)) & 0x7F
+    ).astype(np.uint8)
+    data[ends - 1] |= 0x80
+    return data, num_bytes
+
+
+def vbyte_decode(data: np.ndarray) -> np.ndarray:
+    ends = np.flatnonzero(data & 0x80) + 1
+    if not len(ends):
+        return np.zeros(0, dtype=np.uint64)
+    starts = np.concatenate(([0], ends[:-1]))
+    byte_positions = np.arange(len(data)) - np.repeat(starts, ends - starts)
+    payload = (data & 0x7F).astype(np.uint64) << (7 * byte_positions).astype(np.uint64)
+    return np.add.reduceat(payload, starts)
+
+
+def evict_saved_postings(cache_dir: str, keep: int) -> None:
+    """Remove all but the keep most recently used postings directories in cache_dir."""
+    directories = [
+        entry
+        for entry in os.scandir(cache_dir)
+        if entry.is_dir() and not entry.name.endswith(".tmp")  # still being saved
+    ]
+    directories.sort(key=lambda entry: entry.stat().st_mtime_ns, reverse=True)
+    for entry in directories[keep:]:
+        shutil.rmtree(entry.path, ignore_errors=True)
 
 
 class CustomIndex:
+    # Saved by save() as .npy files, so that load() can memory map them
+    POSTINGS_ARRAYS = (
+        "term_hashes",
+        "doc_freqs",
+        "doc_idx_bytes",
+        "doc_idx_byte_offsets",
+        "freq_bytes",
+        "freq_byte_offsets",
+        "idf",
+        "max_score",
+        "k1_len_norm",
+    )
+
     def __init__(self):
-        self.inverted_index = defaultdict(list)
+        # Where pickling saves the postings instead of copying them, see __getstate__
+        self.postings_cache_dir: str | None = None
         self.doc_lengths = {}
+        # Sum of doc_lengths, kept up to date as documents are added
+        self.total_doc_length = 0
         self.avg_doc_length = 0.0
         self.k1 = 1.2
         self.b = 0.75
         self.metadata = {}  # Store custom metadata here
-        self.tokenizer = CodeTokenizer()
-
-    def add_document(self, title: str, tokens: list[str], metadata: dict = {}) -> None:
+        self.doc_ids: list[str] = []
+        self.doc_id_to_idx: dict[str, int] = {}
+        # (doc index, term ids, frequencies) of the documents added since the last build()
+        self.pending_postings: list[tuple[int, np.ndarray, np.ndarray]] = []
+        # Docs added again since the last build(), whose built postings are replaced
+        self.replaced_doc_idxs: set[int] = set()
+        # Compressed postings per term, sorted by hash_terms id, see build()
+        self.term_hashes = np.zeros(0, dtype=np.uint64)
+        self.doc_freqs = np.zeros(0, dtype=np.int64)
+        self.doc_idx_bytes = np.zeros(0, dtype=np.uint8)
+        self.doc_idx_byte_offsets = np.zeros(1, dtype=np.int64)
+        self.freq_bytes = np.zeros(0, dtype=np.uint8)
+        self.freq_byte_offsets = np.zeros(1, dtype=np.int64)
+        self.idf = np.zeros(0, dtype=np.float32)
+        self.max_score = np.zeros(0, dtype=np.float32)  # best score of each term
+        self.k1_len_norm = np.zeros(0, dtype=np.float32)
+        self.is_built = False
+
+    def add_document(self, title: str, tokens: np.ndarray, metadata: dict = {}) -> None:
         doc_id = title  # You can use title as doc_id or make it more unique
         self.metadata[doc_id] = metadata
         self.index_document(doc_id, tokens)
 
-    def index_document(self, doc_id: str, tokens: list[str]) -> None:
-        doc_length = len(tokens)
-        self.doc_lengths[doc_id] = doc_length
-        self.avg_doc_length = sum(self.doc_lengths.values()) / len(self.doc_lengths)
-
-        token_freq = Counter(tokens)
-        for token, freq in token_freq.items():
-            self.inverted_index[token].append((doc_id, freq))
-
-    def bm25(self, doc_id: str, term: str, term_freq: int) -> float:
-        num_docs = len(self.doc_lengths)
-        idf = log(
-            ((num_docs - len(self.inverted_index[term])) + 0.5)
-            / (len(self.inverted_index[term]) + 0.5)
-            + 1.0
+    def index_document(self, doc_id: str, tokens: np.ndarray) -> None:
+        if doc_id not in self.doc_id_to_idx:
+            self.doc_id_to_idx[doc_id] = len(self.doc_ids)
+            self.doc_ids.append(doc_id)
+        else:
+            # The new tokens replace the old ones, pending or already built
+            doc_idx = self.doc_id_to_idx[doc_id]
+            self.pending_postings = [
+                postings for postings in self.pending_postings if postings[0] != doc_idx
+            ]
+            self.replaced_doc_idxs.add(doc_idx)
+        self.total_doc_length += len(tokens) - self.doc_lengths.get(doc_id, 0)
+        self.doc_lengths[doc_id] = len(tokens)
+
+        term_ids, freqs = np.unique(tokens, return_counts=True)
+        self.pending_postings.append((self.doc_id_to_idx[doc_id], term_ids, freqs))
+        self.is_built = False
+
+    def decode_postings(
+        self, term_idxs: np.ndarray
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Decompress the postings of the given terms into CSR offsets, doc indices and frequencies."""
+        doc_idx_chunks = []
+        freq_chunks = []
+        for term_idx in term_idxs:
+            start, end = self.doc_idx_byte_offsets[term_idx : term_idx + 2]
+            deltas = vbyte_decode(self.doc_idx_bytes[start:end])
+            doc_idx_chunks.append(np.cumsum(deltas).astype(np.int32))
+            start, end = self.freq_byte_offsets[term_idx : term_idx + 2]
+            freq_chunks.append(
+                vbyte_decode(self.freq_bytes[start:end]).astype(np.float32)
+            )
+        offsets = np.zeros(len(term_idxs) + 1, dtype=np.int64)
+        np.cumsum(self.doc_freqs[term_idxs], out=offsets[1:])
+        return (
+            offsets,
+            np.concatenate(doc_idx_chunks or [np.zeros(0, dtype=np.int32)]),
+            np.concatenate(freq_chunks or [np.zeros(0, dtype=np.float32)]),
+        )
+
+    def build(self) -> None:
+        """Merge the pending documents into the compressed postings.
+
+        Each term's postings are sorted by doc index, and stored as VByte encoded
+        doc index gaps and frequencies. The idf of each term and the length
+        normalization of each document, scaled by k1, are precomputed too, as is the
+        highest score each term gives any document, for pruning in search_index.
+        """
+        self.avg_doc_length = (
+            self.total_doc_length / len(self.doc_lengths) if self.doc_lengths else 0.0
         )
-        doc_length = self.doc_lengths[doc_id]
-        tf = ((self.k1 + 1) * term_freq) / (
-            term_freq
-            + self.k1 * (1 - self.b + self.b * (doc_length / self.avg_doc_length))
+        doc_length_arr = np.array(
+            [self.doc_lengths[doc_id] for doc_id in self.doc_ids], dtype=np.float32
+        )
+        self.k1_len_norm = self.k1 * (
+            1 - self.b + self.b * doc_length_arr / (self.avg_doc_length or 1.0)
         )
-        return idf * tf
 
-    def search_index(self, query: str) -> list[tuple[str, float, dict]]:
-        query_tokens = [token.text for token in self.tokenizer(query)]
-        scores = defaultdict(float)
+        # Flatten the existing and the pending postings, then sort them by term and doc
+        deltas = vbyte_decode(self.doc_idx_bytes).astype(np.int64)
+        term_starts = np.cumsum(self.doc_freqs) - self.doc_freqs
+        doc_idxs = np.cumsum(deltas)
+        doc_idxs -= np.repeat(
+            doc_idxs[term_starts] - deltas[term_starts], self.doc_freqs
+        )
+        term_hashes = np.repeat(self.term_hashes, self.doc_freqs)
+        freqs = vbyte_decode(self.freq_bytes).astype(np.int64)
+        if self.replaced_doc_idxs:
+            kept = ~np.isin(doc_idxs, list(self.replaced_doc_idxs))
+            term_hashes = term_hashes[kept]
+            doc_idxs = doc_idxs[kept]
+            freqs = freqs[kept]
+            self.replaced_doc_idxs = set()
+        term_hashes, doc_idxs, freqs = [term_hashes], [doc_idxs], [freqs]
+        for doc_idx, doc_term_hashes, doc_term_freqs in self.pending_postings:
+            term_hashes.append(doc_term_hashes)
+            doc_idxs.append(np.full(len(doc_term_hashes), doc_idx, dtype=np.int32))
+            freqs.append(doc_term_freqs)
+        term_hashes = np.concatenate(term_hashes).astype(np.uint64)
+        doc_idxs = np.concatenate(doc_idxs).astype(np.int64)
+        freqs = np.concatenate(freqs)
+        order = np.lexsort((doc_idxs, term_hashes))
+        term_hashes, doc_idxs, freqs = term_hashes[order], doc_idxs[order], freqs[order]
+        self.pending_postings = []
+
+        self.term_hashes, term_starts, self.doc_freqs = np.unique(
+            term_hashes, return_index=True, return_counts=True
+        )
+        deltas = np.diff(doc_idxs, prepend=0)
+        deltas[term_starts] = doc_idxs[term_starts]
+        posting_offsets = np.append(term_starts, len(doc_idxs))
+        self.doc_idx_bytes, num_bytes = vbyte_encode(deltas)
+        self.doc_idx_byte_offsets = np.concatenate(([0], np.cumsum(num_bytes)))[
+            posting_offsets
+        ]
+        self.freq_bytes, num_bytes = vbyte_encode(freqs)
+        self.freq_byte_offsets = np.concatenate(([0], np.cumsum(num_bytes)))[
+            posting_offsets
+        ]
+
+        num_docs = len(self.doc_ids)
+        # log1p(x) is log(x + 1), without losing precision for the most common terms
+        self.idf = np.log1p(
+            (num_docs - self.doc_freqs + 0.5) / (self.doc_freqs + 0.5)
+        ).astype(np.float32)
+        self.max_score = (
+            np.maximum.reduceat(
+                np.repeat(self.idf * (self.k1 + 1), self.doc_freqs)
+                * self.term_frequency_scores(doc_idxs, freqs),
+                term_starts,
+            ).astype(np.float32)
+            if len(term_starts)
+            else np.zeros(0, dtype=np.float32)
+        )
+        self.is_built = True
+
+    def postings_hash(self) -> str:
+        hasher = blake2b(digest_size=16)
+        for name in self.POSTINGS_ARRAYS:
+            hasher.update(np.ascontiguousarray(getattr(self, name)).tobytes())
+        hasher.update("\0".join(self.doc_ids).encode())
+        return hasher.hexdigest()
+
+    def save(self, directory: str) -> None:
+        """Write the postings to directory, unless an earlier save already did."""
+        if not self.is_built:
+            self.build()
+        if os.path.exists(directory):
+            return
+        os.makedirs(os.path.dirname(directory) or ".", exist_ok=True)
+        # Written to a temporary directory first, so a reader never sees half of it
+        tmp_directory = f"{directory}.{os.getpid()}.tmp"
+        os.makedirs(tmp_directory, exist_ok=True)
+        for name in self.POSTINGS_ARRAYS:
+            np.save(os.path.join(tmp_directory, f"{name}.npy"), getattr(self, name))
+        try:
+            os.rename(tmp_directory, directory)
+        except OSError:  # saved concurrently by another process
+            shutil.rmtree(tmp_directory, ignore_errors=True)
+
+    def load(self, directory: str) -> None:
+        """Memory map the postings written by save(), pages are only read once searched."""
+        for name in self.POSTINGS_ARRAYS:
+            setattr(
+                self,
+                name,
+                np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r"),
+            )
+        os.utime(directory)  # marks it as recently used for evict_saved_postings
+        self.is_built = True
+
+    def __getstate__(self) -> dict:
+        """Pickle the index, saving the postings to disk if postings_cache_dir is set.
+
+        prepare_lexical_search_index_for_state sets it, as file_cache pickles the index.
+        The postings are then saved to a directory named after their hash, and only the
+        directory is pickled, so loading memory maps them rather than copying them. Only
+        the MAX_SAVED_POSTINGS most recently used directories are kept.
+        """
+        if self.postings_cache_dir is None:
+            return self.__dict__.copy()
+        if not self.is_built:
+            self.build()
+        directory = os.path.join(self.postings_cache_dir, self.postings_hash())
+        self.save(directory)
+        os.utime(directory)
+        evict_saved_postings(self.postings_cache_dir, MAX_SAVED_POSTINGS)
+        state = {
+            key: value
+            for key, value in self.__dict__.items()
+            if key not in self.POSTINGS_ARRAYS and key != "doc_id_to_idx"
+        }
+        state["postings_directory"] = directory
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        directory = state.pop("postings_directory", None)
+        self.__dict__.update(state)
+        if directory is not None:
+            # Raises if the saved postings were evicted, file_cache then rebuilds the index
+            self.doc_id_to_idx = {
+                doc_id: idx for idx, doc_id in enumerate(self.doc_ids)
+            }
+            self.load(directory)
+
+    def term_frequency_scores(
+        self, doc_idxs: np.ndarray, freqs: np.ndarray
+    ) -> np.ndarray:
+        # Without the constant k1 + 1 factor, which is folded into each term's weight
+        return freqs / (freqs + self.k1_len_norm[doc_idxs])
+
+    def max_score_search(
+        self, term_idxs: np.ndarray, term_counts: np.ndarray, k: int
+    ) -> np.ndarray:
+        """Term-at-a-time MaxScore over the given query terms, each repeated term_counts times.
+
+        Terms are scored in decreasing order of their best possible score. Once the k-th
+        best document beats everything the remaining terms could add, no new document
+        can reach the top k, so only the documents that still can are scored further.
+        The top k scores are exact, other documents may be left partially scored.
+
+        Only used when a k is given, the module-level search_index asks for every match
+        as ticket_utils fuses all of them with the vector search scores.
+        """
+        # With some slack, as max_score was rounded to float32
+        upper_bounds = term_counts * self.max_score[term_idxs] * (1 + 1e-6)
+        weights = (self.k1 + 1) * term_counts * self.idf[term_idxs]
+        order = np.argsort(-upper_bounds, kind="stable")
+        remaining = upper_bounds.sum()
+        scores = np.zeros(len(self.doc_ids), dtype=np.float32)
+        candidates = None  # docs that can still reach the top k, once new ones can't
+        for i in order:
+            remaining -= upper_bounds[i]
+            _, doc_idxs, freqs = self.decode_postings(term_idxs[i : i + 1])
+            if candidates is not None:
+                in_candidates = candidates[doc_idxs]
+                doc_idxs, freqs = doc_idxs[in_candidates], freqs[in_candidates]
+            np.add.at(
+                scores,
+                doc_idxs,
+                weights[i] * self.term_frequency_scores(doc_idxs, freqs),
+            )
+            if candidates is None and np.count_nonzero(scores) < k:
+                continue
+            threshold = np.partition(scores, len(scores) - k)[len(scores) - k]
+            if candidates is None:
+                if threshold <= remaining:
+                    continue
+                candidates = scores > 0
+            candidates &= scores + remaining >= threshold
+        return scores
+
+    def search_scores(
+        self, query: str, k: int | None = 100
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """The indices of the best k documents matching query, or all if k is None, and their scores.
+
+        Both are sorted by decreasing score.
+        """
+        if k is not None and k <= 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        if not self.is_built:
+            self.build()
+        query_terms, term_counts = tokenize_query(query)
+        term_idxs = np.searchsorted(self.term_hashes, query_terms)
+        found = term_idxs < len(self.term_hashes)
+        found[found] = self.term_hashes[term_idxs[found]] == query_terms[found]
+        # Only the query's own terms are decompressed, and scored with local term ids
+        term_idxs, term_counts = term_idxs[found], term_counts[found]
+        if not len(term_idxs):
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        if k is None or len(term_idxs) <= 1:
+            offsets, doc_idxs, freqs = self.decode_postings(term_idxs)
+            scores = np.zeros(len(self.doc_ids), dtype=np.float32)
+            bm25_kernel.score(
+                np.arange(len(term_idxs), dtype=np.int64),
+                # BM25 is additive, so a repeated term's postings are scanned once
+                (self.k1 + 1) * term_counts * self.idf[term_idxs],
+                offsets,
+                doc_idxs,
+                freqs,
+                self.k1_len_norm,
+                scores,
+            )
+        else:
+            scores = self.max_score_search(term_idxs, term_counts, k)
 
-        for token in query_tokens:
-            for doc_id, term_freq in self.inverted_index.get(token, []):
-                scores[doc_id] += self.bm25(doc_id, token, term_freq)
+        # Every matching document gets a positive score, as idf and tf are positive
+        top_idxs = np.flatnonzero(scores)
+        if k is not None and k < len(top_idxs):
+            top_idxs = top_idxs[np.argpartition(-scores[top_idxs], k - 1)[:k]]
+        top_idxs = top_idxs[np.argsort(-scores[top_idxs], kind="stable")]
+        return top_idxs, scores[top_idxs]
 
-        sorted_scores = sorted(scores.items(), key=lambda x: x[1], reverse=True)
+    def search_index(
+        self, query: str, k: int | None = 100
+    ) -> list[tuple[str, float, dict]]:
+        """Score the documents matching query, returning the best k, or all of them if k is None."""
+        top_idxs, top_scores = self.search_scores(query, k)
 
         # Attach metadata to the results
         results_with_metadata = [
-            (doc_id, score, self.metadata.get(doc_id, {}))
-            for doc_id, score in sorted_scores
+            (
+                self.doc_ids[idx],
+                score,
+                self.metadata.get(self.doc_ids[idx], {}),
+            )
+            for idx, score in zip(top_idxs.tolist(), top_scores.tolist())
         ]
 
         return results_with_metadata
 
 
-word_pattern = re.compile(r"\b\w+\b")
-variable_pattern = re.compile(r"([A-Z][a-z]+|[a-z]+|[A-Z]+(?=[A-Z]|$))")
+# Splits ASCII identifiers into snake_case, camelCase and PascalCase words, acronyms and
+# numbers, e.g. "parseHTTPResponse_v2" into "parse", "HTTP", "Response", "v" and "2".
+# Words never start where the acronym lookahead matches, so trying them first splits the same way
+# with less backtracking
+atom_pattern = re.compile(r"[a-z]+|[A-Z][a-z]+|[A-Z]+(?=[A-Z][a-z])|[A-Z]+|[0-9]+")
+# For non-ASCII text, words and numbers in any script are split by atom_pattern's rules on
+# a string of their letters' cases, u for upper, l for lower and o for caseless (e.g. CJK)
+word_pattern = re.compile(r"[^\W\d_]+|\d+")
+case_pattern = re.compile(r"l+|ul+|u+(?=ul)|u+|o+")
+
+
+def find_atom_spans(code: str) -> Iterator[tuple[int, int]]:
+    """The start and end of each atom in code, as atom_pattern splits them for ASCII."""
+    if code.isascii():
+        for m in atom_pattern.finditer(code):
+            yield m.span()
+        return
+    for word in word_pattern.finditer(code):
+        start, text = word.start(), word.group()
+        if text.isascii():
+            matches = atom_pattern.finditer(text)
+        else:
+            cases = "".join(
+                "u" if char.isupper() else "l" if char.islower() else "o"
+                for char in text
+            )
+            matches = case_pattern.finditer(cases)
+        for m in matches:
+            yield start + m.start(), start + m.end()
 
 
-def tokenize_call(code: str) -> list[Token]:
-    def check_valid_token(token):
-        return token and len(token) > 1
+class Token(NamedTuple):
+    # The fields of whoosh's Token that are read, at a fraction of the allocation cost
+    text: str
+    pos: int
+    startchar: int
+    end_pos: int
+    endchar: int
+
 
-    matches = re.finditer(r"\b\w+\b", code)
-    pos = 0
+def tokenize_call(code: str) -> list[Token]:
     valid_tokens = []
-    for m in matches:
-        text = m.group()
-        span_start = m.start()
-
-        if "_" in text:  # snakecase
-            offset = 0
-            for part in text.split("_"):
-                if check_valid_token(part):
-                    valid_tokens.append(
-                        Token(
-                            text=part.lower(),
-                            pos=pos,
-                            startchar=span_start + offset,
-                            end_pos=pos + 1,
-                            endchar=span_start + len(part) + offset,
-                        )
-                    )
-                    pos += 1
-                offset += len(part) + 1
-        elif parts := variable_pattern.findall(text):  # pascal and camelcase
-            # first one "MyVariable" second one "myVariable" third one "MYVariable"
-            offset = 0
-            for part in parts:
-                if check_valid_token(part):
-                    valid_tokens.append(
-                        Token(
-                            text=part.lower(),
-                            pos=pos,
-                            startchar=span_start + offset,
-                            end_pos=pos + 1,
-                            endchar=span_start + len(part) + offset,
-                        )
-                    )
-                    pos += 1
-                offset += len(part)
-        else:  # everything else
-            if check_valid_token(text):
-                valid_tokens.append(
-                    Token(
-                        text=text.lower(),
-                        pos=pos,
-                        startchar=span_start,
-                        end_pos=pos + 1,
-                        endchar=span_start + len(text),
-                    )
+    for start, end in find_atom_spans(code):
+        if end - start > 1:
+            pos = len(valid_tokens)
+            valid_tokens.append(
+                Token(
+                    text=code[start:end].lower(),
+                    pos=pos,
+                    startchar=start,
+                    end_pos=pos + 1,
+                    endchar=end,
                 )
-                pos += 1
+            )
     return valid_tokens
 
 
-def construct_bigrams(tokens: list[Token]) -> list[Token]:
-    res = []
-    prev_token = None
-    for token in tokens:
-        if prev_token:
-            joined_token = Token(
-                text=prev_token.text + "_" + token.text,
-                pos=prev_token.pos,
-                startchar=prev_token.startchar,
-                end_pos=token.end_pos,
-                endchar=token.endchar,
-            )
-            res.append(joined_token)
-        prev_token = token
-    return res
-
-
-def construct_trigrams(tokens: list[Token]) -> list[Token]:
-    res = []
-    prev_prev_token = None
-    prev_token = None
-    for token in tokens:
-        if prev_token and prev_prev_token:
-            joined_token = Token(
-                text=prev_prev_token.text + "_" + prev_token.text + "_" + token.text,
-                pos=prev_prev_token.pos,
-                startchar=prev_prev_token.startchar,
-                end_pos=token.end_pos,
-                endchar=token.endchar,
-            )
-            res.append(joined_token)
-        prev_prev_token = prev_token
-        prev_token = token
-    return res
-
-
-class CodeTokenizer(Tokenizer):
-    def __call__(
-        self,
-        value,
-        positions=False,
-        chars=False,
-        keeporiginal=False,
-        removestops=True,
-        start_pos=0,
-        start_char=0,
-        mode="",
-        **kwargs,
-    ):
-        tokens = tokenize_call(value)
-        bigrams = construct_bigrams(tokens)
-        trigrams = construct_trigrams(tokens)
-        tokens.extend(bigrams)
-        tokens.extend(trigrams)
-        for token in tokens:
+def tokenize_texts(code: str) -> list[str]:
+    """The texts of the tokens CodeTokenizer yields, without constructing Tokens.
+
+    All unigrams come first, then the bigrams, then the trigrams.
+    """
+    if code.isascii():
+        # findall returns the strings without building a match object for each
+        atoms = atom_pattern.findall(code)
+    else:
+        atoms = [code[start:end] for start, end in find_atom_spans(code)]
+    texts = [atom.lower() for atom in atoms if len(atom) > 1]
+    bigrams = [f"{first}_{second}" for first, second in zip(texts, texts[1:])]
+    trigrams = [
+        f"{first}_{second}_{third}"
+        for first, second, third in zip(texts, texts[1:], texts[2:])
+    ]
+    return texts + bigrams + trigrams
+
+
+class CodeTokenizer:
+    def __call__(self, value: str, **kwargs) -> Iterator[Token]:
+        # Yields each token, then the bigram and trigram ending at it, in one pass
+        prev_prev_token = None
+        prev_token = None
+        for token in tokenize_call(value):
             yield token
+            if prev_token:
+                yield Token(
+                    text=f"{prev_token.text}_{token.text}",
+                    pos=prev_token.pos,
+                    startchar=prev_token.startchar,
+                    end_pos=token.end_pos,
+                    endchar=token.endchar,
+                )
+                if prev_prev_token:
+                    yield Token(
+                        text=f"{prev_prev_token.text}_{prev_token.text}_{token.text}",
+                        pos=prev_prev_token.pos,
+                        startchar=prev_prev_token.startchar,
+                        end_pos=token.end_pos,
+                        endchar=token.endchar,
+                    )
+            prev_prev_token = prev_token
+            prev_token = token
 
 
 @dataclass
@@ -247,18 +612,22 @@ def prepare_index_from_snippets(
         ticket_progress.save()
     all_tokens = []
     try:
-        for i, doc in tqdm(enumerate(all_docs)):
-            document_tokens = compute_document_tokens(doc.content)
+        for i, document_tokens in tqdm(
+            enumerate(compute_all_document_tokens([doc.content for doc in all_docs])),
+            total=len(all_docs),
+        ):
             all_tokens.append(document_tokens)
             if ticket_progress and i % 200 == 0:
                 ticket_progress.search_progress.indexing_progress = i
                 ticket_progress.save()
         for doc, document_tokens in tqdm(zip(all_docs, all_tokens), desc="Indexing"):
             index.add_document(
-                title=f"{doc.title}:{doc.start}-{doc.end}", tokens=document_tokens # snippet.denotation
+                title=f"{doc.title}:{doc.start}-{doc.end}",
+                tokens=document_tokens,  # snippet.denotation
             )
     except FileNotFoundError as e:
         logger.exception(e)
+    index.build()
 
     return index
 
@@ -280,12 +649,17 @@ def prepare_index_from_docs(docs: list[tuple[str, str]]) -> CustomIndex | None:
     # Create the index based on the schema
     index = CustomIndex()
     try:
-        for doc in tqdm(all_docs, total=len(all_docs)):
-            index.add_document(
-                title=f"{doc.url}", tokens=compute_document_tokens(doc.content)
-            )
+        for doc, document_tokens in tqdm(
+            zip(
+                all_docs,
+                compute_all_document_tokens([doc.content for doc in all_docs]),
+            ),
+            total=len(all_docs),
+        ):
+            index.add_document(title=f"{doc.url}", tokens=document_tokens)
     except FileNotFoundError as e:
         logger.exception(e)
+    index.build()
     return index
 
 
@@ -299,43 +673,86 @@ def search_index(query, index: CustomIndex):
     if index == None:
         return {}
     try:
-        # Create a query parser for the "content" field of the index
-        results_with_metadata = index.search_index(query)
-        # Search the index
-        res = {}
-        for doc_id, score, _ in results_with_metadata:
-            if doc_id not in res:
-                res[doc_id] = score
-        # min max normalize scores from 0.5 to 1
-        if len(res) == 0:
-            max_score = 1
-            min_score = 0
-        else:
-            max_score = max(res.values())
-            min_score = min(res.values()) if min(res.values()) < max_score else 0
-        res = {k: (v - min_score) / (max_score - min_score) for k, v in res.items()}
-        return res
+        # Every match is kept, as the scores are fused with the vector search scores
+        top_idxs, scores = index.search_scores(query, k=None)
+        if len(scores) == 0:
+            return {}
+        # min max normalize scores to 0 to 1, the scores are sorted in decreasing order
+        scores = scores.astype(np.float64)
+        max_score = scores[0]
+        min_score = scores[-1] if scores[-1] < max_score else 0
+        normalized_scores = (scores - min_score) / (max_score - min_score)
+        return dict(
+            zip(
+                [index.doc_ids[idx] for idx in top_idxs.tolist()],
+                normalized_scores.tolist(),
+            )
+        )
     except SystemExit:
         raise SystemExit
     except Exception as e:
         logger.exception(e)
         return {}
 
+
 @file_cache(ignore_params=["snippets"])
 def compute_vector_search_scores(query, snippets: list[Snippet]):
     # get get dict of snippet to score
-    snippet_str_to_contents = {snippet.denotation: snippet.get_snippet(add_ellipsis=False, add_lines=False) for snippet in snippets}
-    snippet_contents_array = list(snippet_str_to_contents.values())
-    query_snippet_similarities = get_query_texts_similarity(query, snippet_contents_array)
-    snippet_denotations = [snippet.denotation for snippet in snippets]
-    snippet_denotation_to_scores = {snippet_denotations[i]: score for i, score in enumerate(query_snippet_similarities)}
+    snippet_str_to_contents = {
+        snippet.denotation: snippet.get_snippet(add_ellipsis=False, add_lines=False)
+        for snippet in snippets
+    }
+    # Identical snippets (e.g. vendored or copied files) are only embedded once
+    snippet_contents_array = list(dict.fromkeys(snippet_str_to_contents.values()))
+    query_snippet_similarities = get_query_texts_similarity(
+        query, snippet_contents_array
+    )
+    contents_to_scores = dict(zip(snippet_contents_array, query_snippet_similarities))
+    snippet_denotation_to_scores = {
+        denotation: contents_to_scores[contents]
+        for denotation, contents in snippet_str_to_contents.items()
+    }
     return snippet_denotation_to_scores
 
-@file_cache(ignore_params=["sweep_config"])
+
+def compute_directory_state_hash(directory: str) -> str:
+    """Hash the path, mtime and size of every file in directory, so any edit changes it.
+
+    Hidden files are skipped, like in directory_to_chunks.
+    """
+    file_states = []
+    for file_name in sorted(glob.iglob(f"{directory}/**", recursive=True)):
+        try:
+            file_stat = os.stat(file_name)
+        except FileNotFoundError:
+            continue
+        if stat.S_ISREG(file_stat.st_mode):
+            file_states.append(
+                f"{file_name[len(directory):]}:{file_stat.st_mtime_ns}:{file_stat.st_size}"
+            )
+    return hash_sha256("\n".join(file_states))
+
+
 def prepare_lexical_search_index(
     repo_directory,
     sweep_config,
     ticket_progress: TicketProgress | None = None,
+):
+    # The hash is only read by file_cache, so the repo isn't walked when the cache is off
+    directory_state_hash = (
+        compute_directory_state_hash(repo_directory) if FILE_CACHE_ENABLED else ""
+    )
+    return prepare_lexical_search_index_for_state(
+        repo_directory, directory_state_hash, sweep_config, ticket_progress
+    )
+
+
+@file_cache(ignore_params=["sweep_config", "ticket_progress"])
+def prepare_lexical_search_index_for_state(
+    repo_directory,
+    directory_state_hash: str,  # only part of the cache key, edits to the repo change it
+    sweep_config,
+    ticket_progress: TicketProgress | None = None,
 ):
     snippets, file_list = directory_to_chunks(repo_directory, sweep_config)
     index = prepare_index_from_snippets(
@@ -343,4 +760,7 @@ def prepare_lexical_search_index(
         len_repo_cache_dir=len(repo_directory) + 1,
         ticket_progress=ticket_progress,
     )
+    # The postings are only worth saving when file_cache pickles the index
+    if index is not None and FILE_CACHE_ENABLED:
+        index.postings_cache_dir = LEXICAL_INDEX_CACHE_DIR
     return file_list, snippets, index
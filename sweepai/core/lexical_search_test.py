@@ -0,0 +1,420 @@
+import copy
+import os
+import pickle
+import tempfile
+import unittest
+from collections import Counter
+from math import log
+from unittest.mock import patch
+
+import numpy as np
+
+from sweepai.core import bm25_kernel
+from sweepai.core.entities import Snippet
+from sweepai.core.lexical_search import (
+    CodeTokenizer,
+    CustomIndex,
+    compute_all_document_tokens,
+    compute_directory_state_hash,
+    compute_document_tokens,
+    compute_vector_search_scores,
+    hash_terms,
+    prepare_lexical_search_index,
+    prepare_lexical_search_index_for_state,
+    search_index,
+    tokenize_call,
+    tokenize_query,
+    tokenize_texts,
+    vbyte_decode,
+    vbyte_encode,
+)
+
+documents = {
+    "sweepai/utils/github_utils.py:0-40": """\
+class ClonedRepo:
+    def get_file_contents(self, file_path):
+        with open(file_path) as f:
+            return f.read()
+""",
+    "sweepai/utils/github_utils.py:40-80": """\
+def get_github_client(installation_id):
+    token = get_token(installation_id)
+    return token, Github(token)
+""",
+    "sweepai/core/lexical_search.py:0-40": """\
+def search_index(query, index):
+    results = index.search_index(query)
+    return {doc_id: score for doc_id, score, _ in results}
+""",
+    "README.md:0-10": "Sweep is an AI junior developer that turns bugs and feature requests into code changes.",
+}
+
+
+def reference_scores(index: CustomIndex, query: str) -> dict[str, float]:
+    # Straightforward BM25 over the token lists, to check the index against
+    doc_tokens = {
+        doc_id: tokenize_texts(content) for doc_id, content in documents.items()
+    }
+    num_docs = len(doc_tokens)
+    avg_doc_length = sum(map(len, doc_tokens.values())) / num_docs
+    scores = {}
+    for token in tokenize_texts(query):
+        doc_freq = sum(token in tokens for tokens in doc_tokens.values())
+        if not doc_freq:
+            continue
+        idf = log((num_docs - doc_freq + 0.5) / (doc_freq + 0.5) + 1.0)
+        for doc_id, tokens in doc_tokens.items():
+            term_freq = Counter(tokens)[token]
+            if not term_freq:
+                continue
+            len_norm = 1 - index.b + index.b * len(tokens) / avg_doc_length
+            scores[doc_id] = scores.get(doc_id, 0.0) + idf * (
+                (index.k1 + 1) * term_freq / (term_freq + index.k1 * len_norm)
+            )
+    return scores
+
+
+def build_index() -> CustomIndex:
+    index = CustomIndex()
+    for doc_id, content in documents.items():
+        index.add_document(doc_id, compute_document_tokens(content))
+    return index
+
+
+class TestCustomIndex(unittest.TestCase):
+    queries = [
+        "get file contents",
+        "github client token",
+        "search_index",
+        "sweep junior developer",
+        "nonexistent",
+    ]
+
+    def test_matches_reference_scores(self):
+        index = build_index()
+        for query in self.queries:
+            expected = reference_scores(index, query)
+            results = index.search_index(query)
+            self.assertEqual({doc_id for doc_id, _, _ in results}, set(expected))
+            for doc_id, score, _ in results:
+                self.assertAlmostEqual(score, expected[doc_id], places=4)
+            result_scores = [score for _, score, _ in results]
+            self.assertEqual(result_scores, sorted(result_scores, reverse=True))
+
+    def test_top_k(self):
+        index = CustomIndex()
+        for i in range(200):
+            content = " ".join(
+                ["token"] * (i % 7) + ["file"] * (i % 5) + ["get"] * (i % 3) + ["x"]
+            )
+            index.add_document(f"doc{i}", compute_document_tokens(content))
+        for query in ["get file token", "token token file", "get_file"]:
+            results = index.search_index(query, k=None)
+            np.testing.assert_allclose(
+                [score for _, score, _ in index.search_index(query)],
+                [score for _, score, _ in results[:100]],
+                rtol=1e-5,
+            )
+            for k in [1, 5, 50]:
+                top_k = index.search_index(query, k=k)
+                self.assertEqual(len(top_k), k)
+                np.testing.assert_allclose(
+                    [score for _, score, _ in top_k],
+                    [score for _, score, _ in results[:k]],
+                    rtol=1e-5,
+                )
+            self.assertEqual(index.search_index(query, k=0), [])
+
+    def test_kernels_agree(self):
+        index = build_index()
+        index.build()
+        term_idxs = np.searchsorted(
+            index.term_hashes, hash_terms(["file", "token", "get"])
+        )
+        offsets, doc_idxs, freqs = index.decode_postings(term_idxs)
+        query_term_ids = np.array([0, 1, 2, 1], dtype=np.int64)
+        outs = []
+        for kernel in [bm25_kernel.score_numpy, bm25_kernel.score_loop]:
+            out = np.zeros(len(index.doc_ids), dtype=np.float64)
+            kernel(
+                query_term_ids,
+                (index.k1 + 1) * index.idf[term_idxs],
+                offsets,
+                doc_idxs,
+                freqs,
+                index.k1_len_norm,
+                out,
+            )
+            outs.append(out)
+        np.testing.assert_allclose(outs[0], outs[1], rtol=1e-6)
+
+    def test_documents_added_after_search(self):
+        index = build_index()
+        index.search_index("token")
+        index.add_document("extra.py:0-1", compute_document_tokens("token = 1"))
+        doc_ids = [doc_id for doc_id, _, _ in index.search_index("token")]
+        self.assertIn("extra.py:0-1", doc_ids)
+
+    def test_total_doc_length(self):
+        index = build_index()
+        index.add_document("extra.py:0-1", compute_document_tokens("token = 1"))
+        index.add_document(
+            "extra.py:0-1", compute_document_tokens("token = get_token()")
+        )
+        self.assertEqual(index.total_doc_length, sum(index.doc_lengths.values()))
+        index.build()
+        self.assertAlmostEqual(
+            index.avg_doc_length,
+            sum(index.doc_lengths.values()) / len(index.doc_lengths),
+        )
+
+    def test_readding_document_replaces_it(self):
+        expected = build_index().search_index("get file token")
+        index = build_index()
+        doc_id = "sweepai/utils/github_utils.py:40-80"
+        new_contents = "def get_file(token):\n    return token\n"
+        # Once before and once after the index is built
+        index.add_document(doc_id, compute_document_tokens(new_contents))
+        index.add_document(doc_id, compute_document_tokens(documents[doc_id]))
+        self.assertEqual(index.search_index("get file token"), expected)
+        index.add_document(doc_id, compute_document_tokens(new_contents))
+        index.search_index("get file token")
+        index.add_document(doc_id, compute_document_tokens(documents[doc_id]))
+        self.assertEqual(index.search_index("get file token"), expected)
+
+    def test_rebuild_keeps_postings(self):
+        index = build_index()
+        index.build()
+        expected = index.search_index("get file token")
+        index.build()
+        self.assertEqual(index.search_index("get file token"), expected)
+
+    def test_save_and_load(self):
+        index = build_index()
+        expected = index.search_index("get file token")
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            directory = os.path.join(tmp_dir, "index")
+            index.save(directory)
+            loaded = build_index()
+            loaded.load(directory)
+            self.assertIsInstance(loaded.doc_idx_bytes, np.memmap)
+            self.assertEqual(loaded.search_index("get file token"), expected)
+
+    def test_pickle_maps_saved_postings(self):
+        index = build_index()
+        expected = index.search_index("get file token")
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            index.postings_cache_dir = tmp_dir
+            loaded = pickle.loads(pickle.dumps(index))
+            self.assertEqual(len(os.listdir(tmp_dir)), 1)
+            self.assertIsInstance(loaded.term_hashes, np.memmap)
+            self.assertEqual(loaded.search_index("get file token"), expected)
+            loaded.add_document("extra.py:0-1", compute_document_tokens("token = 1"))
+            doc_ids = [doc_id for doc_id, _, _ in loaded.search_index("token")]
+            self.assertIn("extra.py:0-1", doc_ids)
+
+    def test_pickle_without_cache_dir(self):
+        index = build_index()
+        expected = index.search_index("get file token")
+        with tempfile.TemporaryDirectory() as tmp_dir, patch(
+            "sweepai.core.lexical_search.LEXICAL_INDEX_CACHE_DIR", tmp_dir
+        ):
+            for loaded in (copy.deepcopy(index), pickle.loads(pickle.dumps(index))):
+                self.assertNotIsInstance(loaded.term_hashes, np.memmap)
+                self.assertEqual(loaded.search_index("get file token"), expected)
+            self.assertEqual(os.listdir(tmp_dir), [])
+
+    def test_evicts_least_recently_used_postings(self):
+        with tempfile.TemporaryDirectory() as tmp_dir, patch(
+            "sweepai.core.lexical_search.MAX_SAVED_POSTINGS", 2
+        ):
+            pickles = []
+            for content in ["token = 10", "token = 20", "token = 30"]:
+                index = build_index()
+                index.add_document("extra.py:0-1", compute_document_tokens(content))
+                index.postings_cache_dir = tmp_dir
+                pickles.append(pickle.dumps(index))
+            self.assertEqual(len(os.listdir(tmp_dir)), 2)
+            with self.assertRaises(FileNotFoundError):
+                pickle.loads(pickles[0])
+            pickle.loads(pickles[2])
+
+    def test_search_index_normalizes(self):
+        index = build_index()
+        scores = search_index("github client token", index)
+        self.assertEqual(max(scores.values()), 1.0)
+        results = index.search_index("get file token", k=None)
+        scores = search_index("get file token", index)
+        max_score, min_score = results[0][1], results[-1][1]
+        self.assertLess(min_score, max_score)
+        for doc_id, score, _ in results:
+            self.assertAlmostEqual(
+                scores[doc_id], (score - min_score) / (max_score - min_score)
+            )
+        self.assertTrue(all(0.0 <= score <= 1.0 for score in scores.values()))
+        self.assertEqual(search_index("github", None), {})
+
+
+class TestVByte(unittest.TestCase):
+    def test_round_trip(self):
+        values = np.array(
+            [0, 1, 127, 128, 300, 16383, 16384, 2**21, 2**28 + 5, 2**35 - 1]
+        )
+        data, num_bytes = vbyte_encode(values)
+        self.assertEqual(num_bytes.tolist(), [1, 1, 1, 2, 2, 2, 3, 4, 5, 5])
+        self.assertEqual(len(data), num_bytes.sum())
+        self.assertEqual(vbyte_decode(data).tolist(), values.tolist())
+        self.assertEqual(vbyte_decode(vbyte_encode(np.zeros(0))[0]).tolist(), [])
+
+
+class TestTokenizeCall(unittest.TestCase):
+    def test_splits_identifiers(self):
+        tokens = tokenize_call("def parseHTTPResponse_v2(MAX_SIZE, utf8): return 404")
+        self.assertEqual(
+            [token.text for token in tokens],
+            ["def", "parse", "http", "response", "max", "size", "utf", "return", "404"],
+        )
+        self.assertEqual((tokens[1].startchar, tokens[1].endchar), (4, 9))
+        self.assertEqual([token.pos for token in tokens], list(range(len(tokens))))
+
+    def test_non_ascii(self):
+        code = "日本語 のテキスト café naïve_var ÜberClass 日本語abc"
+        tokens = tokenize_call(code)
+        self.assertEqual(
+            [token.text for token in tokens],
+            ["日本語", "のテキスト", "café", "naïve", "var", "über", "class", "日本語", "abc"],
+        )
+        self.assertEqual(
+            [code[token.startchar : token.endchar] for token in tokens[5:7]],
+            ["Über", "Class"],
+        )
+        self.assertEqual(tokenize_texts(code)[:9], [token.text for token in tokens])
+
+    def test_ngrams(self):
+        code = "self.get_file_contents(path)"
+        self.assertEqual(
+            tokenize_texts(code),
+            [
+                "self",
+                "get",
+                "file",
+                "contents",
+                "path",
+                "self_get",
+                "get_file",
+                "file_contents",
+                "contents_path",
+                "self_get_file",
+                "get_file_contents",
+                "file_contents_path",
+            ],
+        )
+        for content in documents.values():
+            self.assertEqual(
+                sorted(token.text for token in CodeTokenizer()(content)),
+                sorted(tokenize_texts(content)),
+            )
+
+    def test_tokenize_query(self):
+        term_ids, counts = tokenize_query("token = get_token(token)")
+        self.assertEqual(
+            dict(zip(term_ids.tolist(), counts.tolist())),
+            dict(
+                Counter(hash_terms(tokenize_texts("token = get_token(token)")).tolist())
+            ),
+        )
+        self.assertEqual(term_ids.tolist(), sorted(term_ids.tolist()))
+        self.assertIs(tokenize_query("token = get_token(token)")[0], term_ids)
+
+
+class TestComputeAllDocumentTokens(unittest.TestCase):
+    def test_pool_matches_sequential(self):
+        contents = list(documents.values()) * 10
+        expected = [compute_document_tokens(content).tolist() for content in contents]
+        with patch("sweepai.core.lexical_search.SWEEP_TOKENIZE_WORKERS", 2), patch(
+            "sweepai.core.lexical_search.MIN_DOCS_FOR_POOL", 0
+        ):
+            self.assertEqual(
+                [tokens.tolist() for tokens in compute_all_document_tokens(contents)],
+                expected,
+            )
+
+
+class TestComputeVectorSearchScores(unittest.TestCase):
+    def test_duplicate_snippets(self):
+        contents = "def get_token():\n    return token\n"
+        other_contents = "class ClonedRepo:\n    pass\n"
+        snippets = [
+            Snippet(content=contents, start=1, end=2, file_path="a.py"),
+            Snippet(content=contents, start=1, end=2, file_path="a.py"),
+            Snippet(content=contents, start=1, end=2, file_path="vendored/a.py"),
+            Snippet(content=other_contents, start=1, end=2, file_path="repo.py"),
+        ]
+        # Calls the undecorated function, so the result never comes from file_cache
+        compute_scores = getattr(
+            compute_vector_search_scores, "__wrapped__", compute_vector_search_scores
+        )
+        with patch(
+            "sweepai.core.lexical_search.get_query_texts_similarity",
+            return_value=[0.9, 0.1],
+        ) as mock_similarity:
+            scores = compute_scores("get token", snippets)
+        mock_similarity.assert_called_once_with(
+            "get token", [contents.strip("\n"), other_contents.strip("\n")]
+        )
+        self.assertEqual(
+            scores, {"a.py:1-2": 0.9, "vendored/a.py:1-2": 0.9, "repo.py:1-2": 0.1}
+        )
+
+
+class TestComputeDirectoryStateHash(unittest.TestCase):
+    def test_changes_with_files(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            os.makedirs(os.path.join(tmp_dir, "src"))
+            file_path = os.path.join(tmp_dir, "src", "main.py")
+            with open(file_path, "w") as f:
+                f.write("print('hello')\n")
+            state_hash = compute_directory_state_hash(tmp_dir)
+            self.assertEqual(compute_directory_state_hash(tmp_dir), state_hash)
+
+            with open(os.path.join(tmp_dir, ".hidden"), "w") as f:
+                f.write("ignored")
+            self.assertEqual(compute_directory_state_hash(tmp_dir), state_hash)
+
+            with open(file_path, "a") as f:
+                f.write("print('world')\n")
+            self.assertNotEqual(compute_directory_state_hash(tmp_dir), state_hash)
+
+    def test_skipped_without_file_cache(self):
+        with patch("sweepai.core.lexical_search.FILE_CACHE_ENABLED", False), patch(
+            "sweepai.core.lexical_search.compute_directory_state_hash"
+        ) as mock_hash, patch(
+            "sweepai.core.lexical_search.prepare_lexical_search_index_for_state"
+        ) as mock_prepare:
+            prepare_lexical_search_index("/tmp/repo", None)
+        mock_hash.assert_not_called()
+        mock_prepare.assert_called_once_with("/tmp/repo", "", None, None)
+
+    def test_postings_not_saved_without_file_cache(self):
+        for file_cache_enabled in (False, True):
+            with tempfile.TemporaryDirectory() as tmp_dir, patch(
+                "sweepai.core.lexical_search.FILE_CACHE_ENABLED", file_cache_enabled
+            ), patch(
+                "sweepai.core.lexical_search.LEXICAL_INDEX_CACHE_DIR", tmp_dir
+            ), patch(
+                "sweepai.core.lexical_search.directory_to_chunks",
+                return_value=([], []),
+            ), patch(
+                "sweepai.core.lexical_search.prepare_index_from_snippets",
+                return_value=build_index(),
+            ):
+                # Skip file_cache itself, which would otherwise pickle the result
+                _, _, index = prepare_lexical_search_index_for_state.__wrapped__(
+                    "/tmp/repo", "", None
+                )
+                pickle.dumps(index)
+                self.assertEqual(len(os.listdir(tmp_dir)), int(file_cache_enabled))
+
+
+if __name__ == "__main__":
+    unittest.main()
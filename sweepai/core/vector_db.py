@@ -19,13 +19,6 @@ redis_client = Redis.from_url(REDIS_URL)
 # else:
 #     redis_client = None
 
-def cosine_similarity(a, B):
-    dot_product = np.dot(B, a.T)  # B is MxN, a.T is Nx1, resulting in Mx1
-    norm_a = np.linalg.norm(a)
-    norm_B = np.linalg.norm(B, axis=1)
-    return dot_product.flatten() / (norm_a * norm_B)  # Flatten to make it a 1D array
-
-
 def chunk(texts: list[str], batch_size: int) -> Generator[list[str], None, None]:
     texts = [text[:4096] if text else " " for text in texts]
     for text in texts:
@@ -37,9 +30,10 @@ def chunk(texts: list[str], batch_size: int) -> Generator[list[str], None, None]
 @file_cache(ignore_params=["texts"])
 def get_query_texts_similarity(query: str, texts: str) -> float:
     embeddings = embed_texts(texts)
-    embeddings = np.concatenate(embeddings)
-    query_embedding = embed_texts([query])[0]
-    similarity = cosine_similarity(query_embedding, embeddings)
+    embeddings = np.concatenate(embeddings).astype(np.float32)
+    query_embedding = embed_texts([query])[0].astype(np.float32)
+    # Embeddings are L2 normalized, so one matrix-vector product gives the cosine similarities
+    similarity = embeddings @ query_embedding.reshape(-1)
     similarity = similarity.tolist()
     return similarity
 
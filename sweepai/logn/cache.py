@@ -1,3 +1,4 @@
+import functools
 import hashlib
 import inspect
 import os
@@ -8,6 +9,7 @@ from loguru import logger
 from sweepai.config.server import GITHUB_BOT_USERNAME
 
 TEST_BOT_NAME = "sweep-nightly[bot]"
+FILE_CACHE_ENABLED = GITHUB_BOT_USERNAME == TEST_BOT_NAME
 MAX_DEPTH = 6
 
 
@@ -52,10 +54,11 @@ def file_cache(ignore_params=[], verbose=False):
     """
 
     def decorator(func):
-        if GITHUB_BOT_USERNAME != TEST_BOT_NAME:
+        if not FILE_CACHE_ENABLED:
             print("File cache is disabled.")
             return func
 
+        @functools.wraps(func)
         def wrapper(*args, **kwargs):
             cache_dir = "/tmp/file_cache"
             os.makedirs(cache_dir, exist_ok=True)
@@ -3,6 +3,7 @@ from __future__ import annotations
 import ast
 import os
 import re
+import threading
 import traceback
 import uuid
 from dataclasses import dataclass
@@ -215,14 +216,36 @@ def check_valid_typescript(code: str) -> tuple[bool, str]:
     return True, ""
 
 
+_parsers = threading.local()
+
+
+def get_cached_parser(language: str):
+    # Parsers are not thread-safe, so each thread keeps one per language
+    if not hasattr(_parsers, "cache"):
+        _parsers.cache = {}
+    if language not in _parsers.cache:
+        _parsers.cache[language] = get_parser(language)
+    return _parsers.cache[language]
+
+
+def parse_code(language: str, code: bytes):
+    try:
+        return get_cached_parser(language).parse(code)
+    except SystemExit:
+        raise SystemExit
+    except Exception:
+        # Discard the cached parser in case it was left in a bad state and retry with a fresh one
+        _parsers.cache.pop(language, None)
+        return get_cached_parser(language).parse(code)
+
+
 def check_syntax(file_path: str, code: str) -> tuple[bool, str]:
     ext = file_path.split(".")[-1]
     if ext in extension_to_language:
         language = extension_to_language[ext]
     else:
         return True, "Unsupported file extension, skipping syntax check."
-    parser = get_parser(language)
-    tree = parser.parse(code.encode("utf-8"))
+    tree = parse_code(language, code.encode("utf-8"))
 
     if language == "python":
         # First check for syntax errors
@@ -257,6 +280,35 @@ def check_syntax(file_path: str, code: str) -> tuple[bool, str]:
     return True, ""
 
 
+def get_block_spans(file_path: str, code: str) -> list[Span]:
+    # Line spans of the top-level statements, so an edit can be validated on its own block
+    if extension_to_language.get(file_path.split(".")[-1]) != "python":
+        return []
+    tree = parse_code("python", code.encode("utf-8"))
+    return [
+        Span(child.start_point[0], child.end_point[0] + 1)
+        for child in tree.root_node.children
+    ]
+
+
+def check_code_region(
+    file_path: str, code_lines: list[str], line_start: int, line_end: int
+) -> tuple[bool, str]:
+    # Only checks the syntax of lines [line_start, line_end), which should be whole top-level blocks
+    if extension_to_language.get(file_path.split(".")[-1]) != "python":
+        # get_block_spans only splits Python, so check the whole file for other languages
+        return check_syntax(file_path, "\n".join(code_lines))
+    region = "\n".join(code_lines[line_start:line_end])
+    try:
+        ast.parse(region)
+    except SyntaxError as e:
+        error_message = (
+            f"Python syntax error: {e.msg} at line {line_start + (e.lineno or 1)}"
+        )
+        return False, error_message
+    return True, ""
+
+
 def check_code(file_path: str, code: str) -> tuple[bool, str]:
     is_valid, error_message = check_syntax(file_path, code)
     if not is_valid:
@@ -320,11 +372,9 @@ def chunk_code(
             snippets.append(new_snippet)
         return snippets
     try:
-        parser = get_parser(language)
-        tree = parser.parse(code.encode("utf-8"))
-        chunks = chunk_tree(
-            tree, code.encode("utf-8"), MAX_CHARS=MAX_CHARS, coalesce=coalesce
-        )
+        code_bytes = code.encode("utf-8")
+        tree = parse_code(language, code_bytes)
+        chunks = chunk_tree(tree, code_bytes, MAX_CHARS=MAX_CHARS, coalesce=coalesce)
         snippets = []
         for chunk in chunks:
             new_snippet = Snippet(
@@ -1,6 +1,6 @@
 import pytest
 
-from sweepai.utils.utils import check_syntax
+from sweepai.utils.utils import check_code_region, check_syntax, get_block_spans
 
 
 @pytest.mark.parametrize(
@@ -15,3 +15,35 @@ def test_check_syntax(file_path, code, expected_validity, expected_message):
     validity, message = check_syntax(file_path, code)
     assert validity == expected_validity
     assert message == expected_message
+
+
+@pytest.mark.parametrize(
+    "code, line_start, line_end, expected_validity, expected_message",
+    [
+        ("x = (\ndef f():\n    return 1\n", 1, 3, True, ""),
+        (
+            "x = 1\ndef f(:\n    return 1\n",
+            1,
+            3,
+            False,
+            "Python syntax error: invalid syntax at line 2",
+        ),
+    ],
+)
+def test_check_code_region(
+    code, line_start, line_end, expected_validity, expected_message
+):
+    validity, message = check_code_region(
+        "file.py", code.split("\n"), line_start, line_end
+    )
+    assert validity == expected_validity
+    assert message == expected_message
+
+
+def test_get_block_spans():
+    code = "import os\n\n\n@decorator\ndef f():\n    return 1\n\nx = 1\n"
+    assert [(span.start, span.end) for span in get_block_spans("file.py", code)] == [
+        (0, 1),
+        (3, 6),
+        (7, 8),
+    ]